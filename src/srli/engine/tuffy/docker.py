@@ -1,13 +1,19 @@
 import atexit
+import codecs
+import concurrent.futures
 import copy
 import math
+import mmap
 import functools
+import hashlib
 import os
 import re
 import shutil
 import string
+import sys
 import tempfile
 import uuid
+import weakref
 
 import docker
 
@@ -20,29 +26,72 @@ QUERY_FILENAME = 'query.db'
 OUTPUT_FILENAME = 'out.txt'
 
 TEMP_DIR_PREFIX = 'srli.tuffy.'
+# Tuffy's IO files can get large, so prefer to keep them on a RAM-backed filesystem (when available).
+# The environment variable can be used to override this location.
+TEMP_DIR_ENV_VAR = 'SRLI_TMPFS'
+TMPFS_DIR = '/dev/shm'
+
+WRITE_BUFFER_SIZE = 1 << 20
 
 THIS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
 LIB_DIR = os.path.join(THIS_DIR, 'lib')
 
 DOCKER_TAG = 'srli.tuffy'
 DOCKER_TUFFY_IO_DIR = '/tuffy/io'
+DOCKER_TUFFY_SCRIPT = '/tuffy/run-tuffy.sh'
+DOCKER_SERVE_ARG = '--serve'
+DOCKER_EXEC_ARG = '--exec'
+# The image is labeled with a hash of the contents of LIB_DIR, and rebuilt when the hash changes.
+DOCKER_HASH_LABEL = 'srli.tuffy.lib_hash'
+# Set this environment variable (to any non-empty value) to always rebuild the image.
+DOCKER_REBUILD_ENV_VAR = 'SRLI_TUFFY_REBUILD'
 
 # Tuffy variables must start with a lower case letter.
 DUMMY_VARIABLE_PREFIX = 'var_srli__'
 # Tuffy constants must be only integer or start with an upper case letter.
 DUMMY_CONSTANT_PREFIX = 'CON_srli__'
+# Quotes inside of a (quoted) constant must be escaped.
+CONSTANT_ESCAPE_TABLE = str.maketrans({'"': '\\"'})
+
+# A single pattern for the rules in Tuffy's learned weight output.
+# The alternatives are tried in order (priors, soft rules, hard rules),
+# and the name of the outer group that matched identifies the type of rule.
+WEIGHT_PATTERN = re.compile(
+    r'(?P<prior>^(?P<prior_weight>-?\d+(?:\.\d+))\s+!(?P<prior_relation>\w+)\([^\)]+\)\s+\/\/(?P<prior_index>\d+\.\d+)$)'
+    + r'|(?P<soft>^(?P<soft_weight>-?\d+(?:\.\d+))\s+.+?\s+\/\/(?P<soft_index>\d+\.\d+)$)'
+    + r'|(?P<hard> \. \/\/(?P<hard_index>\d+\.\d+)hardfixed$)')
 
 # TODO(eriq): Partial functionals are ignored.
 class Tuffy(srli.engine.base.BaseEngine):
     """
     Run Tuffy in a Docker container.
+
+    If persistent_container is true, then a single container (and IO directory) will be started on the first run
+    and reused for all subsequent runs (until close() is called, the engine is garbage collected, or the process exits).
+    This avoids paying the container (and database) startup cost on every call to learn()/solve().
+
+    If verbose is false, then Tuffy's output will not be forwarded (it is still dumped on failure).
     """
 
-    def __init__(self, relations, rules, cleanup_files = True, include_priors = True, **kwargs):
+    # The image only needs to be checked/built once per process.
+    _image_built = False
+
+    def __init__(self, relations, rules, cleanup_files = True, include_priors = True, persistent_container = False,
+            verbose = True, **kwargs):
         super().__init__(relations, rules, **kwargs)
 
         self._cleanup_files = cleanup_files
         self._include_priors = include_priors
+        self._persistent_container = persistent_container
+        self._verbose = verbose
+
+        # Only used with a persistent container.
+        self._container = None
+        self._io_dir = None
+        self._finalizer = None
+
+        # {relation name (upper case): relation, ...}
+        self._relation_map = {relation.name().upper() : relation for relation in self._relations}
 
         missing_types = False
         for relation in self._relations:
@@ -88,61 +137,146 @@ class Tuffy(srli.engine.base.BaseEngine):
             if (not relation.has_unobserved_data()):
                 continue
 
+            arity = relation.arity()
+            template = self._source_atom_template(relation)
+
             values = []
 
             for row in relation.get_unobserved_data():
-                key = self._convert_source_atom(relation, row)
+                key = template % self._convert_source_arguments(arity, row)
 
-                if (key in raw_results):
-                    value = raw_results[key]
-                else:
-                    # Tuffy does not output zeros.
-                    value = 0.0
-
-                values.append(list(row) + [value])
+                # Copy the row once and add the value in place (Tuffy does not output zeros).
+                value_row = list(row)
+                value_row.append(raw_results.get(key, 0.0))
+                values.append(value_row)
 
             results[relation] = values
 
         return results
 
+    def close(self):
+        """
+        Stop any persistent container and remove its IO directory.
+        """
+
+        if (self._finalizer is not None):
+            self._finalizer()
+            self._finalizer = None
+
+        self._container = None
+        self._io_dir = None
+
+    def _update_finalizer(self):
+        """
+        Make sure that the current persistent resources get released,
+        even if close() is never called.
+        """
+
+        if (self._finalizer is not None):
+            self._finalizer.detach()
+
+        container_id = None
+        if (self._container is not None):
+            container_id = self._container.name
+
+        self._finalizer = weakref.finalize(self, Tuffy._release_resources, container_id, self._io_dir, self._cleanup_files)
+
+    @staticmethod
+    def _release_resources(container_id, io_dir, cleanup_files):
+        if (container_id is not None):
+            Tuffy._stop_container(container_id)
+
+        if ((io_dir is not None) and cleanup_files):
+            shutil.rmtree(io_dir, ignore_errors = True)
+
     def _check_output(self, output_path):
         if (not os.path.isfile(output_path)):
             raise RuntimeError("Tuffy did not complete successfully.")
 
     def _prep_run(self):
-        temp_dir = tempfile.mkdtemp(prefix = TEMP_DIR_PREFIX)
+        if (not self._persistent_container):
+            temp_dir = self._make_temp_dir()
+        else:
+            if (self._io_dir is None):
+                self._io_dir = self._make_temp_dir()
+                self._update_finalizer()
+            temp_dir = self._io_dir
 
         program_path = os.path.join(temp_dir, PROGRAM_FILENAME)
         evidence_path = os.path.join(temp_dir, EVIDENCE_FILENAME)
         query_path = os.path.join(temp_dir, QUERY_FILENAME)
         output_path = os.path.join(temp_dir, OUTPUT_FILENAME)
 
-        self._write_program(program_path)
-        self._write_evidence(evidence_path)
-        self._write_query(query_path)
+        # A reused directory may still hold the output of a previous run.
+        if (os.path.exists(output_path)):
+            os.remove(output_path)
+
+        # The files are independent, so write them concurrently.
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 3) as executor:
+            futures = [
+                executor.submit(self._write_program, program_path),
+                executor.submit(self._write_evidence, evidence_path),
+                executor.submit(self._write_query, query_path),
+            ]
+
+            # Raise any exceptions from the writers.
+            for future in futures:
+                future.result()
 
         return temp_dir, output_path
 
+    def _make_temp_dir(self):
+        base_dir = os.environ.get(TEMP_DIR_ENV_VAR, '')
+        if (base_dir == ''):
+            base_dir = None
+
+        if ((base_dir is None) and os.path.isdir(TMPFS_DIR)):
+            base_dir = TMPFS_DIR
+
+        # Docker will treat a relative path as a named volume instead of a bind mount.
+        return os.path.abspath(tempfile.mkdtemp(prefix = TEMP_DIR_PREFIX, dir = base_dir))
+
     def _cleanup(self, temp_dir):
-        if (self._cleanup_files):
+        if (not self._cleanup_files):
+            return
+
+        if (not self._persistent_container):
             shutil.rmtree(temp_dir)
+            return
+
+        # The directory is mounted in the persistent container, so only remove its contents.
+        for filename in os.listdir(temp_dir):
+            path = os.path.join(temp_dir, filename)
+            if (os.path.isdir(path)):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
 
     def _write_file(self, path, lines):
-        with open(path, 'w') as file:
-            for line in lines:
-                file.write(str(line) + "\n")
+        with open(path, 'w', buffering = WRITE_BUFFER_SIZE) as file:
+            self._advise(file.fileno(), 'POSIX_FADV_SEQUENTIAL')
+            file.writelines(str(line) + "\n" for line in lines)
+
+    def _advise(self, fd, advice_name):
+        """
+        Give the kernel a hint about how a file will be accessed.
+        This is just an optimization, so it is skipped on platforms that do not support it.
+        """
+
+        if ((not hasattr(os, 'posix_fadvise')) or (not hasattr(os, advice_name))):
+            return
+
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice_name))
+        except OSError:
+            pass
 
     def _find_relation(self, name):
-        for relation in self._relations:
-            if (relation.name().upper() == name.upper()):
-                return relation
-        return None
+        return self._relation_map.get(name.upper(), None)
 
     def _parse_weights(self, path):
         ordered_weights = []
 
-        relation_map = {relation.name().upper() : relation for relation in self._relations}
-
         with open(path, 'r') as file:
             skip = True
 
@@ -157,57 +291,63 @@ class Tuffy(srli.engine.base.BaseEngine):
                 if (line == ''):
                     continue
 
-                # Check for priors first.
-                match = re.search(r'^(-?\d+(?:\.\d+))\s+!(\w+)\([^\)]+\)\s+\/\/(\d+\.\d+)$', line)
-                if (match is not None):
-                    weight = float(match.group(1))
-                    relation_name = match.group(2).upper()
+                match = WEIGHT_PATTERN.search(line)
+                if (match is None):
+                    raise ValueError("Could not parse learned Tuffy weight from output rule: '%s'." % (line))
 
-                    if (relation_name not in relation_map):
-                        raise ValueError("Could not find relation (%s) found in prior: '%s'." % (relation_name, line))
+                if (match.lastgroup == 'prior'):
+                    weight = float(match.group('prior_weight'))
+                    relation_name = match.group('prior_relation')
 
-                    relation_map[relation_name].set_negative_prior_weight(weight)
+                    relation = self._find_relation(relation_name)
+                    if (relation is None):
+                        raise ValueError("Could not find relation (%s) found in prior: '%s'." % (relation_name.upper(), line))
 
-                    continue
-
-                # Soft rules.
-                match = re.search(r'^(-?\d+(?:\.\d+))\s+.+?\s+\/\/(\d+\.\d+)$', line)
-                if (match is not None):
-                    weight = float(match.group(1))
-                    index = float(match.group(2))
+                    relation.set_negative_prior_weight(weight)
+                elif (match.lastgroup == 'soft'):
+                    weight = float(match.group('soft_weight'))
+                    index = float(match.group('soft_index'))
 
                     ordered_weights.append((index, weight))
-
-                    continue
-
-                # Hard rules.
-                match = re.search(r' \. \/\/(\d+\.\d+)hardfixed$', line)
-                if (match is not None):
-                    index = float(match.group(1))
+                else:
+                    index = float(match.group('hard_index'))
 
                     ordered_weights.append((index, None))
 
-                    continue
-
-                raise ValueError("Could not parse learned Tuffy weight from output rule: '%s'." % (line))
-
         # Sort the weights according to the index output by Tuffy, which should match the order they were inserted.
         return [weight for (index, weight) in sorted(ordered_weights)]
 
     def _read_results(self, path):
         raw_results = {}
 
-        with open(path, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if (line == ''):
-                    continue
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+
+            # Empty files cannot be mapped.
+            if (size == 0):
+                return raw_results
+
+            self._advise(file.fileno(), 'POSIX_FADV_SEQUENTIAL')
 
-                parts = line.split("\t")
-                atom = parts[0]
-                value = 1.0
+            # Scan the raw bytes and only decode the atoms.
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                start = 0
+                while (start < size):
+                    end = data.find(b'\n', start)
+                    if (end < 0):
+                        end = size
 
-                raw_results[atom] = value
+                    # Only the atom (before any tab) is needed.
+                    atom = data[start:end].strip().partition(b'\t')[0]
+                    start = end + 1
+
+                    if (atom == b''):
+                        continue
+
+                    raw_results[atom.decode()] = 1.0
+
+            # The output will not be read again.
+            self._advise(file.fileno(), 'POSIX_FADV_DONTNEED')
 
         return raw_results
 
@@ -238,21 +378,24 @@ class Tuffy(srli.engine.base.BaseEngine):
             if (rule_texts is None):
                 continue
 
-            for rule_text in rule_texts:
-                if (rule.is_weighted()):
-                    program.append("%f %s" % (rule.weight(), rule_text))
-                else:
-                    program.append("%s ." % (rule_text))
+            if (rule.is_weighted()):
+                template = ("%f " % (rule.weight())) + "%s"
+            else:
+                template = "%s ."
+
+            program += [template % (rule_text) for rule_text in rule_texts]
 
         # Write any prior rules.
         if (self._include_priors and has_prior):
             program.append('')
             for relation in self._relations:
                 if (relation.has_negative_prior_weight()):
-                    arguments = ', '.join([value for value in string.ascii_lowercase[0:relation.arity()]])
+                    arguments = ', '.join(string.ascii_lowercase[0:relation.arity()])
                     program.append("%f !%s(%s)" % (relation.get_negative_prior_weight(), relation.name().upper(), arguments))
 
-        self._write_file(path, program)
+        # The program is small, so write it all at once.
+        with open(path, 'w') as file:
+            file.write("\n".join(program) + "\n")
 
     def _convert_rule(self, rule):
         parsed_rule = srli.parser.parse(rule.text())
@@ -317,94 +460,204 @@ class Tuffy(srli.engine.base.BaseEngine):
 
         return "%s%s(%s)" % (modifier, relation_name, ', '.join(arguments))
 
-    # Convert an atom that comes from a relations's data (i.e. a row).
-    def _convert_source_atom(self, relation, source_atom):
-        relation_name = relation.name().upper()
-        arguments = [self._convert_constant(str(arg)) for arg in source_atom[0:relation.arity()]]
+    # Get a format string for a ground atom of the relation (i.e. a row) that takes the escaped (but unquoted) constants.
+    def _source_atom_template(self, relation):
+        constant_template = '"' + DUMMY_CONSTANT_PREFIX + '%s"'
+        return "%s(%s)" % (relation.name().upper(), ', '.join([constant_template] * relation.arity()))
+
+    def _convert_source_arguments(self, arity, source_atom):
+        # Only slice off the value when there is one.
+        if (len(source_atom) != arity):
+            source_atom = source_atom[0:arity]
 
-        return "%s(%s)" % (relation_name, ', '.join(arguments))
+        return tuple([str(arg).translate(CONSTANT_ESCAPE_TABLE) for arg in source_atom])
 
     def _convert_constant(self, text):
-        text = text.replace('"', '\\"')
-        return '"' + DUMMY_CONSTANT_PREFIX + text + '"'
+        return '"' + DUMMY_CONSTANT_PREFIX + text.translate(CONSTANT_ESCAPE_TABLE) + '"'
 
     def _convert_variable(self, text):
         return DUMMY_VARIABLE_PREFIX + text
 
     def _write_evidence(self, path):
-        evidence = []
+        self._write_file(path, self._generate_evidence())
 
+    def _generate_evidence(self):
         for relation in self._relations:
             if (not relation.has_observed_data()):
                 continue
 
+            arity = relation.arity()
+            template = self._source_atom_template(relation)
+
             for row in relation.get_observed_data():
-                args = list(map(lambda argument: self._convert_constant(argument), row[0:relation.arity()]))
-                line = "%s(%s)" % (relation.name().upper(), ', '.join(map(str, args)))
+                line = template % self._convert_source_arguments(arity, row)
 
-                if (len(row) > relation.arity()):
+                if (len(row) > arity):
                     line = "%f %s" % (float(row[-1]), line)
 
-                evidence.append(line)
-
-        self._write_file(path, evidence)
+                yield line
 
     def _write_query(self, path):
-        query = []
+        self._write_file(path, self._generate_query())
 
+    def _generate_query(self):
         for relation in self._relations:
             if (not relation.has_unobserved_data()):
                 continue
 
-            for row in relation.get_unobserved_data():
-                args = list(map(lambda argument: self._convert_constant(argument), row[0:relation.arity()]))
-                line = "%s(%s)" % (relation.name().upper(), ', '.join(map(str, args)))
-                query.append(line)
+            arity = relation.arity()
+            template = self._source_atom_template(relation)
 
-        self._write_file(path, query)
+            for row in relation.get_unobserved_data():
+                yield template % self._convert_source_arguments(arity, row)
 
     def _run_tuffy(self, io_dir, additional_args = []):
-        client = docker.from_env()
-
-        # Build the image (Docker's cache will be used for subsequent runs).
-        client.images.build(path = LIB_DIR, tag = DOCKER_TAG, rm = True, quiet = False)
+        if (self._persistent_container):
+            self._run_tuffy_persistent(io_dir, additional_args)
+            return
 
-        # Run the container with the temp dir as a mount.
-        volumes = {
-            io_dir: {
-                'bind': DOCKER_TUFFY_IO_DIR,
-                'mode': 'rw',
-            },
-        }
+        client = docker.from_env()
+        self._build_image(client)
 
         container_id = DOCKER_TAG + '_' + str(uuid.uuid4())
         container = None
+        printed_logs = False
+        remove_container_partial = None
 
         try:
             # Ideally we would disable all networking (network_disabled = True),
             # but Tuffy will throw an error.
-            container = client.containers.run(DOCKER_TAG, command = additional_args, volumes = volumes, name = container_id,
-                    remove = True, network_disabled = False,
+            # The container is removed manually, so the logs are still available if Tuffy fails.
+            container = client.containers.run(DOCKER_TAG, command = additional_args, volumes = self._volumes(io_dir), name = container_id,
+                    remove = False, network_disabled = False,
                     detach = True)
 
-            stop_container_partial = functools.partial(Tuffy._stop_container, container_id)
-            atexit.register(stop_container_partial)
+            remove_container_partial = functools.partial(Tuffy._remove_container, container_id)
+            atexit.register(remove_container_partial)
 
-            for line in container.logs(stream = True):
-                print(line.decode(), end = '')
-            print()
+            if (self._verbose):
+                self._print_output(container.logs(stream = True))
+                printed_logs = True
+
+            status = container.wait()['StatusCode']
+            if (status != 0):
+                raise RuntimeError("Tuffy exited with a non-zero status (%s)." % (status))
         except Exception as ex:
-            if (container is not None):
-                print('Tuffy container failed to run, dumping remaining log.')
+            if ((container is not None) and (not printed_logs)):
+                print('Tuffy container failed to run, dumping log.')
                 logs = container.logs()
                 if (logs is not None):
-                    for line in logs:
-                        print(line.decode(), end = '')
-                    print()
+                    self._print_output([logs])
 
             raise ex
         finally:
-            Tuffy._stop_container(container_id)
+            Tuffy._remove_container(container_id)
+
+            if (remove_container_partial is not None):
+                atexit.unregister(remove_container_partial)
+
+    def _run_tuffy_persistent(self, io_dir, additional_args):
+        self._ensure_container(io_dir)
+
+        command = [DOCKER_TUFFY_SCRIPT, DOCKER_EXEC_ARG] + list(additional_args)
+
+        # Use the low-level API so the exit code is available after streaming.
+        api = self._container.client.api
+        exec_id = api.exec_create(self._container.id, command)['Id']
+
+        if (self._verbose):
+            self._print_output(api.exec_start(exec_id, stream = True))
+        else:
+            output = api.exec_start(exec_id)
+
+        exit_code = api.exec_inspect(exec_id)['ExitCode']
+        if (exit_code != 0):
+            if (not self._verbose):
+                print('Tuffy failed to run, dumping log.')
+                self._print_output([output])
+
+            raise RuntimeError("Tuffy exited with a non-zero status (%s)." % (exit_code))
+
+    def _print_output(self, chunks):
+        # Chunks are bytes in arbitrary sizes, so a character may be split across them.
+        decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+
+        for chunk in chunks:
+            sys.stdout.write(decoder.decode(chunk))
+
+        sys.stdout.write(decoder.decode(b'', final = True) + "\n")
+        sys.stdout.flush()
+
+    def _ensure_container(self, io_dir):
+        if (self._container is not None):
+            return
+
+        client = docker.from_env()
+        self._build_image(client)
+
+        container_id = DOCKER_TAG + '_' + str(uuid.uuid4())
+
+        # The container just keeps the database up, Tuffy is run inside of it via exec.
+        self._container = client.containers.run(DOCKER_TAG, command = [DOCKER_SERVE_ARG], volumes = self._volumes(io_dir), name = container_id,
+                remove = True, network_disabled = False,
+                detach = True)
+
+        self._update_finalizer()
+
+    def _build_image(self, client):
+        rebuild = (os.environ.get(DOCKER_REBUILD_ENV_VAR, '') != '')
+
+        if (Tuffy._image_built and not rebuild):
+            return
+
+        lib_hash = Tuffy._hash_lib_dir()
+
+        if (not rebuild):
+            try:
+                image = client.images.get(DOCKER_TAG)
+                if ((image.labels or {}).get(DOCKER_HASH_LABEL) == lib_hash):
+                    Tuffy._image_built = True
+                    return
+            except docker.errors.ImageNotFound:
+                pass
+
+        # Build the image (Docker's cache will be used for any unchanged layers).
+        client.images.build(path = LIB_DIR, tag = DOCKER_TAG, rm = True, quiet = False,
+                labels = {DOCKER_HASH_LABEL: lib_hash})
+        Tuffy._image_built = True
+
+    @staticmethod
+    def _hash_lib_dir():
+        """
+        Hash the paths and contents of all the files used to build the image.
+        """
+
+        lib_hash = hashlib.sha256()
+
+        for (dirpath, dirnames, filenames) in os.walk(LIB_DIR):
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+
+                lib_hash.update(os.path.relpath(path, LIB_DIR).encode())
+                lib_hash.update(b'\0')
+
+                with open(path, 'rb') as file:
+                    lib_hash.update(file.read())
+
+                lib_hash.update(b'\0')
+
+        return lib_hash.hexdigest()
+
+    def _volumes(self, io_dir):
+        # Run the container with the temp dir as a mount.
+        return {
+            io_dir: {
+                'bind': DOCKER_TUFFY_IO_DIR,
+                'mode': 'rw',
+            },
+        }
 
     @staticmethod
     def _stop_container(container_id):
@@ -417,3 +670,13 @@ class Tuffy(srli.engine.base.BaseEngine):
 
         if (container.status == 'running'):
             container.stop()
+
+    @staticmethod
+    def _remove_container(container_id):
+        client = docker.from_env()
+
+        try:
+            container = client.containers.get(container_id)
+            container.remove(force = True)
+        except docker.errors.NotFound:
+            return
@@ -28,12 +28,41 @@ function check_files() {
     fi
 }
 
+readonly SERVE_ARG='--serve'
+readonly EXEC_ARG='--exec'
+readonly POSTGRES_WAIT_ATTEMPTS=60
+readonly POSTGRES_PID_PATH='/var/lib/postgresql/data/postmaster.pid'
+
 function setup_postgres() {
     su postgres -c '/usr/local/bin/docker-entrypoint.sh postgres' &
     # TODO(eriq): Wait for init to complete.
     sleep 2
 }
 
+# Fast shutdown of a serving postgres (bash is PID 1 and will not pass on signals itself).
+function stop_postgres() {
+    if [[ -f "${POSTGRES_PID_PATH}" ]]; then
+        kill -INT "$(head -n 1 "${POSTGRES_PID_PATH}")" || true
+    fi
+
+    wait
+    exit 0
+}
+
+# Wait for an already started (e.g. by a serving container) postgres to accept connections.
+function wait_for_postgres() {
+    for i in $(seq ${POSTGRES_WAIT_ATTEMPTS}); do
+        if pg_isready --quiet --host localhost ; then
+            return 0
+        fi
+
+        sleep 1
+    done
+
+    echo "ERROR: Postgres did not become ready."
+    exit 104
+}
+
 function run_tuffy() {
     java -jar "${JAR_PATH}" -conf "${CONFIG_PATH}" \
         -mln "${PROGRAM_PATH}" \
@@ -47,9 +76,25 @@ function main() {
     set -e
     trap exit SIGINT
 
+    # Just keep the database running, Tuffy will be invoked later (with EXEC_ARG).
+    if [[ "$1" == "${SERVE_ARG}" ]]; then
+        trap stop_postgres SIGTERM
+        setup_postgres
+        wait
+        exit $?
+    fi
+
     check_files
-    setup_postgres
-    run_tuffy $@
+
+    # Postgres was started by a serving container (and may still be initializing).
+    if [[ "$1" == "${EXEC_ARG}" ]]; then
+        shift
+        wait_for_postgres
+    else
+        setup_postgres
+    fi
+
+    run_tuffy "$@"
 }
 
 [[ "${BASH_SOURCE[0]}" == "${0}" ]] && main "$@"
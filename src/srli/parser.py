@@ -285,8 +285,20 @@ class CleanTree(lark.Transformer):
 
         return Constant(str(elements[0]))
 
+_parser = None
+
+# Building the parser (which compiles the grammar) is much more expensive than parsing a rule,
+# so only do it once.
+def _get_parser():
+    global _parser
+
+    if (_parser is None):
+        _parser = lark.Lark(GRAMMAR, start = 'rule', parser = 'lalr')
+
+    return _parser
+
 def parse(rule):
-    parser = lark.Lark(GRAMMAR, start = 'rule', parser = 'lalr')
+    parser = _get_parser()
 
     try:
         ast = parser.parse(rule)
@@ -0,0 +1,177 @@
+import io
+import os
+import unittest.mock
+
+import srli.engine.tuffy.docker
+import srli.relation
+import srli.rule
+import tests.base
+
+Tuffy = srli.engine.tuffy.docker.Tuffy
+
+class TuffyPersistentContainerTest(tests.base.BaseTest):
+    """
+    Check the persistent container handling against a mocked Docker client.
+    """
+
+    def setUp(self):
+        Tuffy._image_built = False
+
+        self._container = unittest.mock.MagicMock()
+        self._container.name = 'srli.tuffy_test'
+        self._container.id = 'test'
+        self._container.status = 'running'
+
+        self._api = self._container.client.api
+        self._api.exec_create.return_value = {'Id': 'exec'}
+        self._api.exec_start.side_effect = self._exec_start
+        self._api.exec_inspect.return_value = {'ExitCode': 0}
+
+        self._client = unittest.mock.MagicMock()
+        self._client.containers.run.return_value = self._container
+        self._client.containers.get.return_value = self._container
+
+        patcher = unittest.mock.patch('docker.from_env', return_value = self._client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _io_dir(self):
+        return list(self._client.containers.run.call_args[1]['volumes'].keys())[0]
+
+    # Pretend to be Tuffy: mark the first query as true.
+    def _exec_start(self, exec_id, stream = False):
+        with open(os.path.join(self._io_dir(), srli.engine.tuffy.docker.OUTPUT_FILENAME), 'w') as file:
+            file.write('SMOKES("CON_srli__A")\n')
+
+        if (stream):
+            return iter([b'Tuffy output.'])
+        return b'Tuffy output.'
+
+    def _make_engine(self, **kwargs):
+        friends = srli.relation.Relation('Friends', variable_types = ['Person', 'Person'])
+        smokes = srli.relation.Relation('Smokes', variable_types = ['Person'])
+
+        friends.add_observed_data([['A', 'B']])
+        smokes.add_unobserved_data([['A'], ['B']])
+
+        rules = [srli.rule.Rule('Friends(A1, A2) & Smokes(A1) -> Smokes(A2)', weight = 0.5)]
+
+        return Tuffy([friends, smokes], rules, persistent_container = True, **kwargs), smokes
+
+    def test_reuse(self):
+        engine, smokes = self._make_engine(verbose = False)
+
+        for i in range(2):
+            results = engine.solve()
+            self.assertEqual(results[smokes], [['A', 1.0], ['B', 0.0]])
+
+        self.assertEqual(self._client.containers.run.call_count, 1)
+        self.assertEqual(self._client.containers.run.call_args[1]['command'], [srli.engine.tuffy.docker.DOCKER_SERVE_ARG])
+
+        self.assertEqual(self._api.exec_create.call_count, 2)
+        command = self._api.exec_create.call_args[0][1]
+        self.assertEqual(command[0:2], [srli.engine.tuffy.docker.DOCKER_TUFFY_SCRIPT, srli.engine.tuffy.docker.DOCKER_EXEC_ARG])
+
+        io_dir = self._io_dir()
+        self.assertTrue(os.path.isdir(io_dir))
+
+        engine.close()
+
+        self.assertFalse(os.path.exists(io_dir))
+        self._container.stop.assert_called_once()
+
+    def test_failure(self):
+        engine, smokes = self._make_engine(verbose = False)
+        self._api.exec_inspect.return_value = {'ExitCode': 1}
+
+        with unittest.mock.patch('sys.stdout', new_callable = io.StringIO) as stdout:
+            with self.assertRaises(RuntimeError):
+                engine.solve()
+
+        self.assertIn('Tuffy output.', stdout.getvalue())
+
+        engine.close()
+
+class TuffyImageTest(tests.base.BaseTest):
+    """
+    Check when the Docker image gets (re)built.
+    """
+
+    def setUp(self):
+        Tuffy._image_built = False
+
+        self._client = unittest.mock.MagicMock()
+
+        patcher = unittest.mock.patch.dict('os.environ', {srli.engine.tuffy.docker.DOCKER_REBUILD_ENV_VAR: ''})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _set_image_hash(self, lib_hash):
+        self._client.images.get.return_value.labels = {srli.engine.tuffy.docker.DOCKER_HASH_LABEL: lib_hash}
+
+    def test_current_image(self):
+        self._set_image_hash(Tuffy._hash_lib_dir())
+
+        Tuffy._build_image(None, self._client)
+        self._client.images.build.assert_not_called()
+
+    def test_stale_image(self):
+        self._set_image_hash('stale')
+
+        Tuffy._build_image(None, self._client)
+        self._client.images.build.assert_called_once()
+
+        labels = self._client.images.build.call_args[1]['labels']
+        self.assertEqual(labels[srli.engine.tuffy.docker.DOCKER_HASH_LABEL], Tuffy._hash_lib_dir())
+
+    def test_missing_image(self):
+        self._client.images.get.side_effect = srli.engine.tuffy.docker.docker.errors.ImageNotFound('missing')
+
+        Tuffy._build_image(None, self._client)
+        self._client.images.build.assert_called_once()
+
+    def test_forced_rebuild(self):
+        self._set_image_hash(Tuffy._hash_lib_dir())
+
+        with unittest.mock.patch.dict('os.environ', {srli.engine.tuffy.docker.DOCKER_REBUILD_ENV_VAR: '1'}):
+            Tuffy._build_image(None, self._client)
+
+        self._client.images.build.assert_called_once()
+
+class TuffyContainerTest(tests.base.BaseTest):
+    """
+    Check failure handling for a (non-persistent) container against a mocked Docker client.
+    """
+
+    def setUp(self):
+        Tuffy._image_built = True
+
+        self._container = unittest.mock.MagicMock()
+        self._container.wait.return_value = {'StatusCode': 1}
+        self._container.logs.return_value = b'FAILED'
+
+        self._client = unittest.mock.MagicMock()
+        self._client.containers.run.return_value = self._container
+        self._client.containers.get.return_value = self._container
+
+        patcher = unittest.mock.patch('docker.from_env', return_value = self._client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failure(self):
+        friends = srli.relation.Relation('Friends', variable_types = ['Person', 'Person'])
+        smokes = srli.relation.Relation('Smokes', variable_types = ['Person'])
+
+        friends.add_observed_data([['A', 'B']])
+        smokes.add_unobserved_data([['A'], ['B']])
+
+        rules = [srli.rule.Rule('Friends(A1, A2) & Smokes(A1) -> Smokes(A2)', weight = 0.5)]
+        engine = Tuffy([friends, smokes], rules, verbose = False)
+
+        with unittest.mock.patch('sys.stdout', new_callable = io.StringIO) as stdout:
+            with self.assertRaises(RuntimeError):
+                engine.solve()
+
+        self.assertIn('FAILED', stdout.getvalue())
+        self.assertFalse(self._client.containers.run.call_args[1]['remove'])
+        self._container.remove.assert_called_once_with(force = True)